@@ -1,4 +1,59 @@
+from functools import partial
 import openmdao.api as om
+import numpy as np
+
+# Set to True to print the solver residuals at every iteration
+VERBOSE = False
+
+try:
+    from numba import njit
+except ImportError:
+    # Fall back to plain Python if numba isn't installed
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+@njit(cache=True, fastmath=True)
+def _diode_kernel(deltaV, Is, invVt):
+    """
+    Returns the Shockley diode current and its derivative wrt the voltage drop.
+    """
+    x = deltaV * invVt
+    if x > 40.:
+        # Continue the exponential linearly past exp(40) so a poor initial guess can't overflow to inf,
+        # while the slope still matches the current and Newton can step straight back
+        e40 = np.exp(40.)
+        return Is * (e40 * (1. + x - 40.) - 1.), Is * e40 * invVt
+    e = np.exp(x)
+    return Is * (e - 1.), Is * e * invVt
+
+def guess_voltages(I_in, Vg=0., R1=100., R2=10000., Is=1e-15, Vt=0.025875):
+    """
+    Estimates the two node voltages, assuming R2 >> R1 so nearly all of the source current flows through R1.
+    """
+    V1 = Vg + I_in * R1
+    # The diode passes whatever leaks through R2, which sets its forward voltage; it is off if V1 is below ground
+    V2 = Vg + Vt * np.log1p(max((V1 - Vg) / (R2 * Is), 0.))
+    return V1, V2
+
+def solve_circuit(I_in, Vg=0., R1=100., R2=10000., Is=1e-15, Vt=0.025875, V1=None, V2=None, tol=1e-10, maxiter=20):
+    """
+    Solves for the two node voltages with Newton's method on the closed-form residuals and 2x2 Jacobian.
+    """
+    if V1 is None or V2 is None:
+        V1, V2 = guess_voltages(I_in, Vg, R1, R2, Is, Vt)
+    invR1, invR2, invVt = 1/R1, 1/R2, 1/Vt
+    x = np.array([V1, V2], dtype=float)
+    for _ in range(maxiter):
+        I_D1, g_D1 = _diode_kernel(x[1] - Vg, Is, invVt)
+        I_R2 = (x[0] - x[1]) * invR2
+        F = np.array([I_in - (x[0] - Vg) * invR1 - I_R2, I_R2 - I_D1])
+        J = np.array([[-invR1 - invR2, invR2],
+                      [invR2, -invR2 - g_D1]])
+        dx = np.linalg.solve(J, -F)
+        x += dx
+        if np.linalg.norm(dx) < tol:
+            return x[0], x[1]
+    raise om.AnalysisError(f'solve_circuit failed to converge in {maxiter} iterations (|dx| = {np.linalg.norm(dx):.3e} V)')
 
 class Resistor(om.ExplicitComponent):
     """
@@ -13,12 +68,13 @@ class Resistor(om.ExplicitComponent):
         self.add_input('V_out', units='V')
         self.add_output('I', units='A')
         
-        self.declare_partials('I', 'V_in', method='fd')
-        self.declare_partials('I', 'V_out', method='fd')
+        # Analytic derivatives - Partial derivatives are constant, so their values can be assigned in setup
+        self._invR = 1/self.options['R']
+        self.declare_partials('I', 'V_in', rows=[0], cols=[0], val=self._invR)
+        self.declare_partials('I', 'V_out', rows=[0], cols=[0], val=-self._invR)
         
     def compute(self, inputs, outputs):
-        deltaV = inputs['V_in'] - inputs['V_out']
-        outputs['I'] = deltaV / self.options['R']
+        outputs['I'] = (inputs['V_in'] - inputs['V_out']) * self._invR
         
 class Diode(om.ExplicitComponent):
     """
@@ -34,14 +90,23 @@ class Diode(om.ExplicitComponent):
         self.add_input('V_out', units='V')
         self.add_output('I', units='A')
         
-        self.declare_partials('I', 'V_in', method='fd')
-        self.declare_partials('I', 'V_out', method='fd')
+        # Analytic derivatives declaration
+        self.declare_partials('I', 'V_in', rows=[0], cols=[0])
+        self.declare_partials('I', 'V_out', rows=[0], cols=[0])
+        
+        # Options are fixed once set up, so bind them into the kernel rather than looking them up on every call
+        self._diode_kernel = partial(_diode_kernel, Is=self.options['Is'], invVt=1/self.options['Vt'])
         
     def compute(self, inputs, outputs):
-        deltaV = inputs['V_in'] - inputs['V_out']
-        Is = self.options['Is']
-        Vt = self.options['Vt']
-        outputs['I'] = Is* (np.exp(deltaV / Vt) - 1)
+        deltaV = inputs['V_in'][0] - inputs['V_out'][0]
+        outputs['I'] = self._diode_kernel(deltaV)[0]
+    
+    def compute_partials(self, inputs, J):
+        deltaV = inputs['V_in'][0] - inputs['V_out'][0]
+        dI_dV = self._diode_kernel(deltaV)[1]
+        
+        J['I', 'V_in'] = dI_dV
+        J['I', 'V_out'] = -dI_dV
 
 class Node(om.ImplicitComponent):
     """
@@ -55,47 +120,162 @@ class Node(om.ImplicitComponent):
     def setup(self):
         self.add_output('V', val=5., units='V')
         
-        for i in range(self.options['n_in']):
-            i_name = f'I_in:{i}'
+        # Cache the current names so the residual evaluation doesn't rebuild them on every call
+        self._in_names = [f'I_in:{i}' for i in range(self.options['n_in'])]
+        self._out_names = [f'I_out:{i}' for i in range(self.options['n_out'])]
+        
+        for i_name in self._in_names:
             self.add_input(i_name, units='A')
             
-        for i in range(self.options['n_out']):
-            i_name = f'I_out:{i}'
+        for i_name in self._out_names:
             self.add_input(i_name, units='A')
             
         # Note: We don't declare any partials wrt `V` here, because the residual doesn't directly depend on it
-        self.declare_partials('V', 'I*', method='fd')
+        # Analytic derivatives - The residual is a linear sum of currents, so the partials are constant
+        for i_name in self._in_names:
+            self.declare_partials('V', i_name, val=1.)
+        for i_name in self._out_names:
+            self.declare_partials('V', i_name, val=-1.)
         
     def apply_nonlinear(self, inputs, outputs, residuals):
-        residuals['V'] = 0.
-        for i_conn in range(self.options['n_in']):
-            residuals['V'] += inputs[f'I_in:{i_conn}']
-        for i_conn in range(self.options['n_out']):
-            residuals['V'] += inputs[f'I_out:{i_conn}']
+        # Accumulate into a scalar so no intermediate arrays are allocated
+        I_net = 0.
+        for i_name in self._in_names:
+            I_net += inputs[i_name][0]
+        for i_name in self._out_names:
+            I_net -= inputs[i_name][0]
+        residuals['V'] = I_net
+
+# ModifiedNewtonSolver overrides private NewtonSolver hooks (_linearize, _iter_get_norm) as they are in OpenMDAO 3.45,
+# so check it against NewtonSolver._single_iteration when upgrading.
+class ModifiedNewtonSolver(om.NewtonSolver):
+    """
+    Newton solver that reuses the factorized Jacobian across iterations, only refactorizing
+    periodically or when convergence stalls. The partials are still recomputed on every iteration,
+    so this only saves the factorization itself.
+    """
+    
+    SOLVER = 'NL: Modified Newton'
+    
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._norm_prev = None
+        
+    def _declare_options(self):
+        super()._declare_options()
+        self.options.declare('refactor_every', default=3, types=int, desc='Number of iterations between Jacobian refactorizations')
+        self.options.declare('refactor_ratio', default=0.5, types=float, lower=0., desc='Refactorize when the residual norm ratio exceeds this value')
+        
+    def _iter_initialize(self):
+        self._norm_prev = None
+        return super()._iter_initialize()
+        
+    def _linearize(self):
+        norm = self._iter_get_norm()
+        refactor = (self._norm_prev is None
+                    or self._iter_count % self.options['refactor_every'] == 0
+                    or norm > self.options['refactor_ratio'] * self._norm_prev)
+        self._norm_prev = norm
+        
+        # Otherwise the linear solver keeps its previous factorization and only the line search is updated
+        if refactor:
+            super()._linearize()
+        elif self.linesearch is not None:
+            self.linesearch._linearize()
 
 class Circuit(om.Group):
     
     def setup(self):
-        self.add_subsystem('n1', Node(n_in=1, n_out=2), promotes_inputs=[('I_in:0', 'I_in')])
-        self.add_subsystem('n2', Node()) # Leaving defaults
+        # The node voltages, source current and ground are shared through promotion
+        self.add_subsystem('n1', Node(n_in=1, n_out=2), promotes_inputs=[('I_in:0', 'I_in')], promotes_outputs=[('V', 'V1')])
+        self.add_subsystem('n2', Node(), promotes_outputs=[('V', 'V2')]) # Leaving defaults
         
-        self.add_subsystem('R1', Resistor(R=100.), promotes_inputs=[('V_out', 'Vg')])
-        self.add_subsystem('R2', Resistor(R=10000.))
-        self.add_subsystem('D1', Diode(), promotes_inputs=[('V_out', 'Vg')])
+        self.add_subsystem('R1', Resistor(R=100.), promotes_inputs=[('V_in', 'V1'), ('V_out', 'Vg')])
+        self.add_subsystem('R2', Resistor(R=10000.), promotes_inputs=[('V_in', 'V1'), ('V_out', 'V2')])
+        self.add_subsystem('D1', Diode(), promotes_inputs=[('V_in', 'V2'), ('V_out', 'Vg')])
         
-        # USE PROMOTES
-        self.connect('n1.V', ['R1.V_in', 'R2.V_in'])
+        # Only the branch currents into each node are connected
         self.connect('R1.I', 'n1.I_out:0')
-        self.connect('R2.I', 'n1.I_out:1')
-        
-        self.connect('n2.V', ['R2.V_out', 'D1.V_in'])
-        self.connect('R2.I', 'n2.I_in:0')
+        self.connect('R2.I', ['n1.I_out:1', 'n2.I_in:0'])
         self.connect('D1.I', 'n2.I_out:0')
         
+        # Swap in ModifiedNewtonSolver() to reuse the factorization across iterations on larger circuits
         self.nonlinear_solver = om.NewtonSolver()
-        self.nonlinear_solver.options['iprint'] = 2
+        self.nonlinear_solver.options['solve_subsystems'] = False
+        self.nonlinear_solver.options['iprint'] = 2 if VERBOSE else -1
         self.nonlinear_solver.options['maxiter'] = 20
-        self.linear_solver = om.DirectSolver()
+        # Assemble a sparse CSC Jacobian so DirectSolver factorizes it with a sparse LU
+        self.options['assembled_jac_type'] = 'csc'
+        self.linear_solver = om.DirectSolver(assemble_jac=True)
+        
+class TwoNodeCircuit(om.ImplicitComponent):
+    """
+    Computes both node voltage residuals of the circuit in a single component, with the resistor and diode currents inlined.
+    """
+    
+    def initialize(self):
+        self.options.declare('R1', default=100., desc='Resistance of R1 in Ohms')
+        self.options.declare('R2', default=10000., desc='Resistance of R2 in Ohms')
+        self.options.declare('Is', default=1e-15, desc='Saturation current of D1 in Amps')
+        self.options.declare('Vt', default=0.025875, desc='Thermal voltage of D1 in Volts')
+        
+    def setup(self):
+        self.add_input('I_in', units='A')
+        self.add_input('Vg', units='V')
+        self.add_output('V1', val=5., units='V')
+        self.add_output('V2', val=5., units='V')
+        
+        self._invR1 = 1/self.options['R1']
+        self._invR2 = 1/self.options['R2']
+        self._diode_kernel = partial(_diode_kernel, Is=self.options['Is'], invVt=1/self.options['Vt'])
+        
+        # Analytic derivatives - Only the diode terms change, so the rest are assigned in setup
+        self.declare_partials('V1', 'I_in', val=1.)
+        self.declare_partials('V1', 'Vg', val=self._invR1)
+        self.declare_partials('V1', 'V1', val=-self._invR1 - self._invR2)
+        self.declare_partials('V1', 'V2', val=self._invR2)
+        self.declare_partials('V2', 'Vg')
+        self.declare_partials('V2', 'V1', val=self._invR2)
+        # V2 only depends on I_in through V1, but without declaring it OpenMDAO drops the
+        # I_in term from reverse-mode derivatives of V2. The subjac is never set, so it stays zero.
+        self.declare_partials('V2', 'I_in')
+        self.declare_partials('V2', 'V2')
+        
+    def apply_nonlinear(self, inputs, outputs, residuals):
+        V1, V2, Vg = outputs['V1'][0], outputs['V2'][0], inputs['Vg'][0]
+        I_R1 = (V1 - Vg) * self._invR1
+        I_R2 = (V1 - V2) * self._invR2
+        I_D1 = self._diode_kernel(V2 - Vg)[0]
+        
+        residuals['V1'] = inputs['I_in'] - I_R1 - I_R2
+        residuals['V2'] = I_R2 - I_D1
+        
+    def solve_nonlinear(self, inputs, outputs):
+        # Converge both voltages directly instead of relying on an OpenMDAO Newton solver, warm-started from the current outputs
+        outputs['V1'], outputs['V2'] = solve_circuit(inputs['I_in'][0], inputs['Vg'][0],
+                                                     R1=self.options['R1'], R2=self.options['R2'],
+                                                     Is=self.options['Is'], Vt=self.options['Vt'],
+                                                     V1=outputs['V1'][0], V2=outputs['V2'][0])
+        
+    def linearize(self, inputs, outputs, J):
+        g_D1 = self._diode_kernel(outputs['V2'][0] - inputs['Vg'][0])[1]
+        
+        J['V2', 'Vg'] = g_D1
+        J['V2', 'V2'] = -self._invR2 - g_D1
+        
+        # Invert the 2x2 state Jacobian here so solve_linear doesn't need a DirectSolver
+        self._inv_jac = np.linalg.inv([[-self._invR1 - self._invR2, self._invR2],
+                                       [self._invR2, -self._invR2 - g_D1]])
+        
+    def solve_linear(self, d_outputs, d_residuals, mode):
+        if mode == 'fwd':
+            d_V = self._inv_jac @ [d_residuals['V1'][0], d_residuals['V2'][0]]
+            d_outputs['V1'] = d_V[0]
+            d_outputs['V2'] = d_V[1]
+        else:
+            d_R = self._inv_jac.T @ [d_outputs['V1'][0], d_outputs['V2'][0]]
+            d_residuals['V1'] = d_R[0]
+            d_residuals['V2'] = d_R[1]
         
 prob = om.Problem()
 model = prob.model
@@ -109,8 +289,32 @@ model.connect('ground.V', 'circuit.Vg')
 
 prob.setup()
 
+# Initial values close to the operating point keep Newton in its quadratic convergence basin
+prob['circuit.V1'], prob['circuit.V2'] = guess_voltages(prob['source.I'][0], prob['ground.V'][0],
+                                                        R1=model.circuit.R1.options['R'], R2=model.circuit.R2.options['R'],
+                                                        Is=model.circuit.D1.options['Is'], Vt=model.circuit.D1.options['Vt'])
+
+prob.run_model()
+
+# Same circuit with both nodes fused into one component, so Newton runs without any transfers between subsystems
+fused_prob = om.Problem()
+fused_model = fused_prob.model
+
+fused_model.add_subsystem('ground', om.IndepVarComp('V', 0., units='V'))
+fused_model.add_subsystem('source', om.IndepVarComp('I', 0.1, units='A'))
+fused_model.add_subsystem('circuit', TwoNodeCircuit())
+
+fused_model.connect('source.I', 'circuit.I_in')
+fused_model.connect('ground.V', 'circuit.Vg')
+
+# The component converges itself in solve_nonlinear, so the default RunOnce solvers are enough
+
+fused_prob.setup()
+
 # Initial values
-prob['circuit.n1.V'] = 10.
-prob['circuit.n2.V'] = 1.
+fused_circuit = fused_model.circuit
+fused_prob['circuit.V1'], fused_prob['circuit.V2'] = guess_voltages(fused_prob['source.I'][0], fused_prob['ground.V'][0],
+                                                                    R1=fused_circuit.options['R1'], R2=fused_circuit.options['R2'],
+                                                                    Is=fused_circuit.options['Is'], Vt=fused_circuit.options['Vt'])
 
-prob.run_model()
\ No newline at end of file
+fused_prob.run_model()
\ No newline at end of file
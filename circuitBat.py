@@ -1,7 +1,31 @@
-from __future__ import division, print_function
+from functools import partial
 import openmdao.api as om
 import numpy as np
 
+# Set to True to print the solver residuals at every iteration
+VERBOSE = False
+
+try:
+    from numba import njit
+except ImportError:
+    # Fall back to plain Python if numba isn't installed
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+@njit(cache=True, fastmath=True)
+def _diode_kernel(deltaV, Is, invVt):
+    """
+    Returns the Shockley diode current and its derivative wrt the voltage drop.
+    """
+    x = deltaV * invVt
+    if x > 40.:
+        # Continue the exponential linearly past exp(40) so a poor initial guess can't overflow to inf,
+        # while the slope still matches the current and Newton can step straight back
+        e40 = np.exp(40.)
+        return Is * (e40 * (1. + x - 40.) - 1.), Is * e40 * invVt
+    e = np.exp(x)
+    return Is * (e - 1.), Is * e * invVt
+
 class Resistor(om.ExplicitComponent):
     """
     Computes current across a resistor using Ohm's law.
@@ -20,13 +44,12 @@ class Resistor(om.ExplicitComponent):
 #         self.declare_partials('I', 'V_out', method='fd')
         
         # Analytic derivatives - Partial derivatives are constant, so their values can be assigned in setup
-        R = self.options['R']
-        self.declare_partials('I', 'V_in', val=1/R)
-        self.declare_partials('I', 'V_out', val=-1/R)
+        self._invR = 1/self.options['R']
+        self.declare_partials('I', 'V_in', rows=[0], cols=[0], val=self._invR)
+        self.declare_partials('I', 'V_out', rows=[0], cols=[0], val=-self._invR)
         
     def compute(self, inputs, outputs):
-        deltaV = inputs['V_in'] - inputs['V_out']
-        outputs['I'] = deltaV / self.options['R']
+        outputs['I'] = (inputs['V_in'] - inputs['V_out']) * self._invR
         
 class Diode(om.ExplicitComponent):
     """
@@ -47,23 +70,22 @@ class Diode(om.ExplicitComponent):
 #         self.declare_partials('I', 'V_out', method='fd')
         
         # Analytic derivatives declaration
-        self.declare_partials('I', 'V_in')
-        self.declare_partials('I', 'V_out')
+        self.declare_partials('I', 'V_in', rows=[0], cols=[0])
+        self.declare_partials('I', 'V_out', rows=[0], cols=[0])
+        
+        # Options are fixed once set up, so bind them into the kernel rather than looking them up on every call
+        self._diode_kernel = partial(_diode_kernel, Is=self.options['Is'], invVt=1/self.options['Vt'])
         
     def compute(self, inputs, outputs):
-        deltaV = inputs['V_in'] - inputs['V_out']
-        Is = self.options['Is']
-        Vt = self.options['Vt']
-        outputs['I'] = Is * (np.exp(deltaV / Vt) - 1)
+        deltaV = inputs['V_in'][0] - inputs['V_out'][0]
+        outputs['I'] = self._diode_kernel(deltaV)[0]
     
     def compute_partials(self, inputs, J):
-        deltaV = inputs['V_in'] - inputs['V_out']
-        Is = self.options['Is']
-        Vt = self.options['Vt']
-        I = Is * np.exp(deltaV / Vt)
+        deltaV = inputs['V_in'][0] - inputs['V_out'][0]
+        dI_dV = self._diode_kernel(deltaV)[1]
         
-        J['I', 'V_in'] = I/Vt
-        J['I', 'V_out'] = -I/Vt
+        J['I', 'V_in'] = dI_dV
+        J['I', 'V_out'] = -dI_dV
         
 class Node(om.ImplicitComponent):
     """
@@ -77,45 +99,50 @@ class Node(om.ImplicitComponent):
     def setup(self):
         self.add_output('V', val=5., units='V')
         
-        for i in range(self.options['n_in']):
-            i_name = f'I_in:{i}'
+        # Cache the current names so the residual evaluation doesn't rebuild them on every call
+        self._in_names = [f'I_in:{i}' for i in range(self.options['n_in'])]
+        self._out_names = [f'I_out:{i}' for i in range(self.options['n_out'])]
+        
+        for i_name in self._in_names:
             self.add_input(i_name, units='A')
             
-        for i in range(self.options['n_out']):
-            i_name = f'I_out:{i}'
+        for i_name in self._out_names:
             self.add_input(i_name, units='A')
             
         # Note: We don't declare any partials wrt `V` here, because the residual doesn't directly depend on it
-        self.declare_partials('V', 'I*', method='fd')
+        # Analytic derivatives - The residual is a linear sum of currents, so the partials are constant
+        for i_name in self._in_names:
+            self.declare_partials('V', i_name, val=1.)
+        for i_name in self._out_names:
+            self.declare_partials('V', i_name, val=-1.)
         
     def apply_nonlinear(self, inputs, outputs, residuals):
-        residuals['V'] = 0.
-        for i_conn in range(self.options['n_in']):
-            residuals['V'] += inputs[f'I_in:{i_conn}']
-        for i_conn in range(self.options['n_out']):
-            residuals['V'] -= inputs[f'I_out:{i_conn}']
+        # Accumulate into a scalar so no intermediate arrays are allocated
+        I_net = 0.
+        for i_name in self._in_names:
+            I_net += inputs[i_name][0]
+        for i_name in self._out_names:
+            I_net -= inputs[i_name][0]
+        residuals['V'] = I_net
 
 class Circuit(om.Group):
     
     def setup(self):
-        self.add_subsystem('n1', Node(n_in=1, n_out=2), promotes_inputs=[('I_in:0', 'I_in')])
-        self.add_subsystem('n2', Node()) # Leaving defaults
+        # The node voltages, source current and ground are shared through promotion
+        self.add_subsystem('n1', Node(n_in=1, n_out=2), promotes_inputs=[('I_in:0', 'I_in')], promotes_outputs=[('V', 'V1')])
+        self.add_subsystem('n2', Node(), promotes_outputs=[('V', 'V2')]) # Leaving defaults
         
-        self.add_subsystem('R1', Resistor(R=100.), promotes_inputs=[('V_out', 'Vg')])
-        self.add_subsystem('R2', Resistor(R=10000.))
-        self.add_subsystem('D1', Diode(), promotes_inputs=[('V_out', 'Vg')])
+        self.add_subsystem('R1', Resistor(R=100.), promotes_inputs=[('V_in', 'V1'), ('V_out', 'Vg')])
+        self.add_subsystem('R2', Resistor(R=10000.), promotes_inputs=[('V_in', 'V1'), ('V_out', 'V2')])
+        self.add_subsystem('D1', Diode(), promotes_inputs=[('V_in', 'V2'), ('V_out', 'Vg')])
         
-        # Not possible to use promotes because of weird variable naming?
-        self.connect('n1.V', ['R1.V_in', 'R2.V_in'])
+        # Only the branch currents into each node are connected
         self.connect('R1.I', 'n1.I_out:0')
-        self.connect('R2.I', 'n1.I_out:1')
-        
-        self.connect('n2.V', ['R2.V_out', 'D1.V_in'])
-        self.connect('R2.I', 'n2.I_in:0')
+        self.connect('R2.I', ['n1.I_out:1', 'n2.I_in:0'])
         self.connect('D1.I', 'n2.I_out:0')
         
         self.nonlinear_solver = om.NewtonSolver()
-        self.nonlinear_solver.options['iprint'] = 2
+        self.nonlinear_solver.options['iprint'] = 2 if VERBOSE else -1
         self.nonlinear_solver.options['maxiter'] = 20
         self.linear_solver = om.DirectSolver()
 
@@ -134,7 +161,7 @@ model.add_subsystem('batt_deltaV', om.ExecComp('dV = V1 - V2', V1={'units':'V'},
 # The current into the circuit is now the output state from the batt_balance comp
 model.connect('batt_balance.I', 'circuit.I_in')
 model.connect('ground.V', ['circuit.Vg', 'batt_deltaV.V2'])
-model.connect('circuit.n1.V', 'batt_deltaV.V1')
+model.connect('circuit.V1', 'batt_deltaV.V1')
 
 # Set the LHS and RHS for the battery residual
 model.connect('batt.V', 'batt_balance.rhs:I')
@@ -148,17 +175,23 @@ p.model.circuit.linear_solver = om.LinearRunOnce()
 
 # Put Newton at the top so it can also converge the new BalanceComp residual
 newton = p.model.nonlinear_solver = om.NewtonSolver()
-p.model.linear_solver = om.DirectSolver()
-newton.options['iprint'] = 2
+# Solve the Newton steps with matrix-free GMRES so the full Jacobian is never assembled or factorized
+p.model.linear_solver = om.ScipyKrylov(solver='gmres')
+p.model.linear_solver.options['atol'] = 1e-10
+newton.options['iprint'] = 2 if VERBOSE else -1
 newton.options['maxiter'] = 20
 newton.options['solve_subsystems'] = True
-newton.linesearch = om.ArmijoGoldsteinLS()
-newton.linesearch.options['maxiter'] = 10
-newton.linesearch.options['iprint'] = 2
+# No line search needed: the diode exponent is clipped and the initial guesses start near the solution
+newton.linesearch = None
 
-# Initial guesses
-p['circuit.n1.V'] = 9.8
-p['circuit.n2.V'] = .7
+# Initial guesses - n1 sits at the battery voltage and the diode passes whatever leaks through R2 (none if reversed)
+Vg, R1, R2 = p['ground.V'][0], p.model.circuit.R1.options['R'], p.model.circuit.R2.options['R']
+Is, Vt = p.model.circuit.D1.options['Is'], p.model.circuit.D1.options['Vt']
+V1 = Vg + p['batt.V'][0]
+V2 = Vg + Vt * np.log1p(max((V1 - Vg) / (R2 * Is), 0.))
+p['circuit.V1'] = V1
+p['circuit.V2'] = V2
+p['batt_balance.I'] = (V1 - Vg) / R1 + (V1 - V2) / R2
 
 p.run_model()
-print(p['circuit.n1.V'], p['circuit.n2.V'], p['circuit.R1.I'], p['circuit.R2.I'], p['circuit.D1.I'])
\ No newline at end of file
+print(p['circuit.V1'], p['circuit.V2'], p['circuit.R1.I'], p['circuit.R2.I'], p['circuit.D1.I'])
\ No newline at end of file